@@ -16,18 +16,35 @@
 
 # Based on redash_toolbelt's save_queries example
 
+import hashlib
+import json
 import os
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import ruamel.yaml
 from dotenv import load_dotenv
 from redash_toolbelt.client import Redash
 
-from util import make_filename
+from util import fsync_all, make_filename, make_redash_client
 
 METAFILE_SUFFIX = ".meta.yaml"
 
+# Digests of the last-saved state of each query, so unchanged queries can
+# skip the expensive round-trip YAML reload of their meta file
+FETCH_CACHE_FILE = ".fetch-cache.json"
+
+# Rewrites dashboard ids in link columns to 0 so saved files are stable
+# across instances, compiled once as it runs per column per visualization
+DASHBOARD_URL_SUB_RE = re.compile(r'(^/dashboards/)[0-9]+(-[a-z0-9-]+\?.+|$)')
+
+# Round trip YAML instance shared by the savers for both load and dump, so
+# its resolver/representer setup happens once per run rather than per call.
+# The savers run single-threaded, which is all a YAML instance supports.
+RT_YAML = ruamel.yaml.YAML()
+
 QUERY_META_FIELDS = [
     "name",
     "description",
@@ -65,6 +82,44 @@ DASHBOARD_WIDGET_IGNORE_FIELDS = {
     "visualization"
 }
 
+def paginate_prefetch(executor, resource, page_size=100):
+    """Yield items from a paginated redash resource, prefetching pages.
+
+    redash_toolbelt's Redash.paginate fetches every page before returning
+    anything. Requesting page N+1 in the background as soon as page N
+    arrives hides the list-page round trips behind the per-item detail
+    requests the caller issues while consuming this generator.
+
+    Arguments:
+    executor -- ThreadPoolExecutor to run the page requests on
+    resource -- Paginated resource method, e.g. redash.queries
+    page_size -- Number of items per page
+    """
+    future = executor.submit(resource, page=1, page_size=page_size)
+    while future is not None:
+        response = future.result()
+        if response["page"] * response["page_size"] < response["count"]:
+            future = executor.submit(resource, page=response["page"] + 1,
+                                     page_size=page_size)
+        else:
+            future = None
+        yield from response["results"]
+
+
+def query_digest(query: dict) -> str:
+    """Digest of the parts of a query that save_queries writes to disk.
+
+    If this matches the digest recorded on the previous fetch, the meta file
+    on disk is already up to date and the reload/rewrite can be skipped.
+    """
+    subset = {field: query[field]
+              for field in QUERY_META_FIELDS if field in query}
+    if "visualizations" in query:
+        subset["visualizations"] = query["visualizations"]
+    return hashlib.sha1(json.dumps(
+        subset, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
 def save_queries(datasources: dict, queries: dict, pathToQueries: str):
     """Save redash queries to disk as yaml and meta files.
 
@@ -73,71 +128,127 @@ def save_queries(datasources: dict, queries: dict, pathToQueries: str):
     queries -- List of queries to save
     pathToQueries -- directory on filesystem to put files
     """
-    yaml = ruamel.yaml.YAML()
-
+    try:
+        with open(FETCH_CACHE_FILE, "r", encoding="utf-8") as cache_file:
+            cache: dict = json.load(cache_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    new_cache: dict = {}
+
+    # Everything written this run, synced in one batch at the end
+    written_paths: list = []
+
+    # Group queries by datasource so the directory, makedirs call and syntax
+    # lookup happen once per datasource instead of once per query
+    buckets = defaultdict(list)
     for query in queries.values():
-        source: dict = datasources[query["data_source_id"]]
-
-        # path looks like queries/type/name.format
-        path: str = os.sep.join([pathToQueries, source["type"], make_filename(
-            query["name"]) + "." + source["syntax"]])
-
-        os.makedirs(os.sep.join([pathToQueries, source["type"]]), exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(query["query"])
-            if not query["query"].endswith("\n"):
-                f.write("\n")
-
-        # Object that becomes the meta file
-        metadata: dict = {}
-
-        # Load existing metadata with round trip loader if it exists
-        try:
-            with open(path + METAFILE_SUFFIX, "r",
-                      encoding="utf-8") as orig_meta_file:
-                metadata = ruamel.yaml.load(
-                    orig_meta_file, ruamel.yaml.RoundTripLoader)
-
-        except FileNotFoundError:
-            pass
-
-        # Change queryId to queryName on query based parameters
-        if "parameters" in query["options"]:
-            for param in query["options"]["parameters"]:
-                if param["type"] == "query":
-                    param["queryName"] = queries[param["queryId"]]["name"]
-                    del param["queryId"]
-
-        # Store main metadata fields
-        for field in QUERY_META_FIELDS:
-            if field in query:
-                # only overwrite fields if they have changed to improve YAML round trip
-                if metadata.get(field) != query.get(field):
-                    metadata[field] = query[field]
-
-        # Store visualizations
-        if "visualizations" in query:
-            for viz in query["visualizations"]:
-                for field in VISUALIZATIONS_IGNORE_FIELDS:
-                    if field in viz:
-                        del viz[field]
-
-                for column in viz["options"].get("columns", []):
-                    if column.get("displayAs") == "link":
-                        column["linkUrlTemplate"] = re.sub(r'(^/dashboards/)[0-9]+(-[a-z0-9-]+\?.+|$)', r'\g<1>0\g<2>', column["linkUrlTemplate"])
-
-            metadata["visualizations"] = [i for i in query["visualizations"] if i != {
-                "type": "TABLE",
-                "name": "Table",
-                "options": {},
-                "description": ""
-            }]
-
-            metadata["visualizations"].sort(key=lambda i: i.get("name"))
-
-        # Write to disk
-        with open(path + METAFILE_SUFFIX, "w", encoding="utf-8") as meta_file:
-            yaml.dump(metadata, meta_file)
+        buckets[query["data_source_id"]].append(query)
+
+    for data_source_id, bucket in buckets.items():
+        source: dict = datasources[data_source_id]
+
+        # paths look like queries/type/name.format
+        type_dir: str = os.path.join(pathToQueries, source["type"])
+        syntax: str = source["syntax"]
+        os.makedirs(type_dir, exist_ok=True)
+
+        for query in bucket:
+            path: str = os.path.join(
+                type_dir, make_filename(query["name"]) + "." + syntax)
+            query_text = query["query"]
+            if not query_text.endswith("\n"):
+                query_text += "\n"
+
+            # Leave the file alone if the text hasn't changed, so mtimes (and
+            # anything watching them, like git status) stay quiet on no-op runs
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    query_text_current = f.read() == query_text
+            except FileNotFoundError:
+                query_text_current = False
+
+            if not query_text_current:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(query_text)
+                written_paths.append(path)
+
+            # Skip the meta file entirely if nothing changed since the last
+            # fetch - the round-trip reload below dominates CPU time otherwise.
+            # Digest is taken before any of the rewrites below mutate the query.
+            digest = query_digest(query)
+            new_cache[str(query["id"])] = digest
+            if (cache.get(str(query["id"])) == digest
+                    and os.path.exists(path + METAFILE_SUFFIX)):
+                continue
+
+            # Object that becomes the meta file
+            metadata: dict = {}
+
+            # Load existing metadata with the round trip instance if it exists
+            try:
+                with open(path + METAFILE_SUFFIX, "r",
+                          encoding="utf-8") as orig_meta_file:
+                    metadata = RT_YAML.load(orig_meta_file) or {}
+
+            except FileNotFoundError:
+                pass
+
+            # Change queryId to queryName on query based parameters
+            if "parameters" in query["options"]:
+                for param in query["options"]["parameters"]:
+                    if param["type"] == "query":
+                        param["queryName"] = queries[param["queryId"]]["name"]
+                        del param["queryId"]
+
+            # Only rewrite the file if something below actually changed it, so
+            # unchanged meta files keep their mtime
+            dirty = False
+
+            # Store main metadata fields
+            for field in QUERY_META_FIELDS:
+                if field in query:
+                    # only overwrite fields if they have changed to improve YAML round trip
+                    if metadata.get(field) != query.get(field):
+                        metadata[field] = query[field]
+                        dirty = True
+
+            # Store visualizations
+            if "visualizations" in query:
+                for viz in query["visualizations"]:
+                    for field in VISUALIZATIONS_IGNORE_FIELDS:
+                        if field in viz:
+                            del viz[field]
+
+                    for column in viz["options"].get("columns", []):
+                        if column.get("displayAs") == "link":
+                            column["linkUrlTemplate"] = DASHBOARD_URL_SUB_RE.sub(r'\g<1>0\g<2>', column["linkUrlTemplate"])
+
+                visualizations = [i for i in query["visualizations"] if i != {
+                    "type": "TABLE",
+                    "name": "Table",
+                    "options": {},
+                    "description": ""
+                }]
+
+                visualizations.sort(key=lambda i: i.get("name"))
+
+                if metadata.get("visualizations") != visualizations:
+                    metadata["visualizations"] = visualizations
+                    dirty = True
+
+            # Write to disk
+            if dirty:
+                with open(path + METAFILE_SUFFIX, "w",
+                          encoding="utf-8") as meta_file:
+                    RT_YAML.dump(metadata, meta_file)
+                written_paths.append(path + METAFILE_SUFFIX)
+
+    # Rebuilt from scratch each run so deleted queries drop out
+    with open(FETCH_CACHE_FILE, "w", encoding="utf-8") as cache_file:
+        json.dump(new_cache, cache_file)
+    written_paths.append(FETCH_CACHE_FILE)
+
+    fsync_all(written_paths)
 
 
 def save_dashboards(dashboards: list, pathToDashboards: str):
@@ -147,31 +258,43 @@ def save_dashboards(dashboards: list, pathToDashboards: str):
     dashboards -- List of dashboards to save
     pathToDashboards -- directory on filesystem to put files
     """
-    yaml = ruamel.yaml.YAML()
     os.makedirs(pathToDashboards, exist_ok=True)
 
+    written_paths: list = []
+
     for dashboard in dashboards:
-        path: str = os.sep.join(
-            [pathToDashboards, make_filename(dashboard["name"]) + ".yaml"])
+        path: str = os.path.join(
+            pathToDashboards, make_filename(dashboard["name"]) + ".yaml")
 
         # Object that becomes the meta file
         dashboard_data: dict = {}
 
-        # Load existing dashboard_data with round trip loader if it exists
+        # Load existing dashboard_data with the round trip instance if it exists
         try:
             with open(path, "r", encoding="utf-8") as orig_meta_file:
-                dashboard_data = ruamel.yaml.load(
-                    orig_meta_file, ruamel.yaml.RoundTripLoader)
+                dashboard_data = RT_YAML.load(orig_meta_file) or {}
 
         except FileNotFoundError:
             pass
 
+        # Only rewrite the file if something below actually changed it
+        dirty = False
+
         for i in DASHBOARD_FIELDS:
             if dashboard_data.get(i, None) != dashboard[i]:
                 dashboard_data[i] = dashboard[i]
-
-        dashboard_data["widgets"] = []
-        dashboard["widgets"].sort(key=lambda i: (i["options"]["position"]["row"],i["options"]["position"]["col"]))
+                dirty = True
+
+        # Sort widgets by position via a precomputed key list rather than a
+        # lambda chasing nested dicts for every element
+        orig_widgets = dashboard["widgets"]
+        position_keys = [(w["options"]["position"]["row"],
+                          w["options"]["position"]["col"])
+                         for w in orig_widgets]
+        order = sorted(range(len(orig_widgets)), key=position_keys.__getitem__)
+        orig_widgets[:] = [orig_widgets[i] for i in order]
+
+        widgets = []
         for orig_widget in dashboard["widgets"]:
             filtered_widget = {k: orig_widget[k] for k in orig_widget.keys() if k not in DASHBOARD_WIDGET_IGNORE_FIELDS}
             if "visualization" in orig_widget:
@@ -179,10 +302,18 @@ def save_dashboards(dashboards: list, pathToDashboards: str):
                     "name": orig_widget["visualization"]["name"],
                     "queryName": orig_widget["visualization"]["query"]["name"]
                 }
-            dashboard_data["widgets"].append(filtered_widget)
+            widgets.append(filtered_widget)
 
-        with open(path, "w", encoding="utf-8") as dashboard_file:
-            yaml.dump(dashboard_data, dashboard_file)
+        if dashboard_data.get("widgets") != widgets:
+            dashboard_data["widgets"] = widgets
+            dirty = True
+
+        if dirty:
+            with open(path, "w", encoding="utf-8") as dashboard_file:
+                RT_YAML.dump(dashboard_data, dashboard_file)
+            written_paths.append(path)
+
+    fsync_all(written_paths)
 
 
 @click.command()
@@ -205,16 +336,30 @@ def main(redash_url: str, api_key: str):
     pathToQueries = "queries"
     pathToDashboards = "dashboards"
 
-    redash: Redash = Redash(redash_url.rstrip("/"), api_key)
-    datasources: dict = {
-        i["id"]: i for i in redash.get_data_sources()}
-    queries: dict = {q["id"]: redash.get_query(
-        q["id"]) for q in redash.paginate(redash.queries)}
-    save_queries(datasources, queries, pathToQueries)
-
-    dashboards = [redash.get_dashboard(d["id"])
-                  for d in redash.paginate(redash.dashboards)]
-    save_dashboards(dashboards, pathToDashboards)
+    redash: Redash = make_redash_client(redash_url, api_key)
+
+    # The datasource, query and dashboard listings don't depend on each
+    # other, so all three start immediately, and the per-item GETs fan out
+    # on the same pool while later listing pages are still in flight
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        def fetch_details(resource, get_item):
+            item_futures = [
+                executor.submit(get_item, item["id"])
+                for item in paginate_prefetch(executor, resource)]
+            return [future.result() for future in item_futures]
+
+        datasources_future = executor.submit(redash.get_data_sources)
+        queries_future = executor.submit(
+            fetch_details, redash.queries, redash.get_query)
+        dashboards_future = executor.submit(
+            fetch_details, redash.dashboards, redash.get_dashboard)
+
+        datasources: dict = {
+            i["id"]: i for i in datasources_future.result()}
+        queries: dict = {q["id"]: q for q in queries_future.result()}
+        save_queries(datasources, queries, pathToQueries)
+
+        save_dashboards(dashboards_future.result(), pathToDashboards)
 
 
 if __name__ == "__main__":
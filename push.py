@@ -16,6 +16,8 @@
 
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 
 import click
@@ -24,8 +26,41 @@ import ruamel.yaml
 from dotenv import load_dotenv
 from redash_toolbelt.client import Redash
 
+from util import make_redash_client
+
 METAFILE_SUFFIX = ".meta.yaml"
 
+# Matches dashboard links like /dashboards/3-class-summary?p_class={{ id }},
+# compiled once as it runs for every link column of every visualization
+DASHBOARD_URL_RE = re.compile(r'^/dashboards/([0-9]+)-([a-z0-9-]+)(\?.+|$)')
+
+# Per-query locks for upload_query, created on demand under the guard.
+# Kept out of the query payloads, which get JSON-serialized wholesale.
+UPLOAD_LOCKS_GUARD = threading.Lock()
+UPLOAD_LOCKS: dict = {}
+
+# Query names the current thread is part-way through uploading. Backstop
+# for callers that reach upload_query without upload_queries' up-front
+# cycle check: a cycle walked by one thread raises instead of deadlocking
+# on its own non-reentrant lock.
+UPLOAD_IN_PROGRESS = threading.local()
+
+# Fields upload_query may send to update_query: the metadata fetch saves,
+# plus the query text and datasource binding. Visualizations are uploaded
+# through their own endpoint.
+QUERY_UPDATE_FIELDS = [
+    "name",
+    "description",
+    "is_archived",
+    "is_draft",
+    "is_favourite",
+    "options",
+    "schedule",
+    "tags",
+    "query",
+    "data_source_id"
+]
+
 
 def create_visualization(redash: Redash, data):
     """Add a visualisation to a query.
@@ -65,29 +100,28 @@ def delete_widget(redash: Redash, widget_id):
     return redash._delete("api/widgets/{}".format(widget_id))
 
 
-def fix_dashboard_url_id(url: str, existing_dashboards):
+def fix_dashboard_url_id(url: str, slug_to_id: dict):
     """Fix the ids in links to dashboard urls by looking up the slug
 
     Arguments:
     url -- The url to fix
-    existing_dashboards -- The existing dashboards downloaded from the redash server
+    slug_to_id -- Mapping of dashboard slug to id on the redash server
     """
     # If URL looks like /dashboards/3-class-summary?p_class={{ id }}
-    matches = re.search(r'^/dashboards/([0-9]+)-([a-z0-9-]+)(\?.+|$)', url)
+    matches = DASHBOARD_URL_RE.search(url)
     if not matches:
         return url
     slug = matches.group(2)
     query = matches.group(3)
-    try:
-        id = [d["id"] for d in existing_dashboards.values() if d["slug"] == slug][0]
-        return f"/dashboards/{id}-{slug}{query}"
-    except IndexError as e:
-        logging.error(f"Could not find dashboard with slug {slug}; {e}")
-    return url
+    id = slug_to_id.get(slug)
+    if id is None:
+        logging.error(f"Could not find dashboard with slug {slug}")
+        return url
+    return f"/dashboards/{id}-{slug}{query}"
 
 
 def upload_query(redash: Redash, query_name: str, saved_queries,
-    existing_queries, existing_dashboards):
+    existing_queries, slug_to_id: dict):
     """Upload a query to a redash server
 
     Returns ID of query uploaded.
@@ -101,93 +135,142 @@ def upload_query(redash: Redash, query_name: str, saved_queries,
     query that has already been uploaded, it will just return the previous ID
     (which it saves in the "uploaded_id" of the saved queries)
 
+    Safe to call concurrently from upload_queries' worker threads: a
+    per-query lock means a query shared as a dependency is still only
+    uploaded once, while unrelated queries proceed in parallel.
+
     Arguments:
     redash -- Redash toolbelt instance to upload to
     query_name -- Name of the query to upload
     saved_queries -- Name-indexed dict of queries loaded from disk
     existing_queries -- Name-indexed dict of existing queries from redash server
-    existing_dashboards -- Dict of existing dashboards from redash server
+    slug_to_id -- Mapping of dashboard slug to id on the redash server
     """
 
     query_data = saved_queries[query_name]
 
-    # If we already have an "uploaded_id", we've already been uploaded, just return the ID.
-    if "uploaded_id" in query_data:
-        return query_data["uploaded_id"]
-
-    # Change queryName back to queryId on query based parameters
-    if "parameters" in query_data["options"]:
-        for param in query_data["options"]["parameters"]:
-            if param["type"] == "query":
-                # Get queryId by calling ourselves recursively
-                # - ensures that depended on query is already uploaded
-                param["queryId"] = upload_query(
-                    redash, param["queryName"], saved_queries, existing_queries,
-                    existing_dashboards)
-                del param["queryName"]
-
-    # Query does not exist on server, create it
-    if query_name not in existing_queries:
-        print("Uploading query '%s' ..." %
-              (query_name), end="")
-        new_query = redash.create_query(query_data).json()
-        existing_queries[query_name] = new_query
-
-    # Update it even if just uploaded to ensure published status is correct
-    query_id = existing_queries[query_name]["id"]
-    print("Updating query '%s' ..." %
-          (query_name), end="")
-    redash.update_query(query_id, query_data)
-
-    print("done")
-    query_data["uploaded_id"] = query_id
-
-    existing_visualisations = \
-        {viz["name"]: viz for viz in
-         existing_queries[query_name]["visualizations"]}
-    for visualization in query_data["visualizations"]:
-        visualization["query_id"] = query_id
-
-        for column in visualization["options"].get("columns", []):
-            if column.get("displayAs") == "link":
-                column["linkUrlTemplate"] = fix_dashboard_url_id(
-                    column["linkUrlTemplate"], existing_dashboards)
-
-        if visualization["name"] in existing_visualisations:
-            print("  Updating visualization '%s' ..." %
-                  (visualization["name"]), end="")
-            uploaded_viz = redash.update_visualization(
-                existing_visualisations[visualization["name"]]["id"],
-                visualization).json()
-        else:
-            print("  Creating visualization '%s' ..." %
-                  (visualization["name"]), end="")
-
-            uploaded_viz = create_visualization(redash, visualization)
-        # redash.create_visualization(visualization)
-
-        visualization["uploaded_id"] = uploaded_viz["id"]
-        print("done")
-
-    return query_id
-
+    # Per-query lock so concurrent workers that share this query as a
+    # dependency wait for the first upload instead of racing it
+    with UPLOAD_LOCKS_GUARD:
+        lock = UPLOAD_LOCKS.setdefault(query_name, threading.Lock())
+
+    # A query depending on itself (directly or through other queries) would
+    # block forever on its own lock; fail loudly instead. Cycles spanning
+    # several workers are rejected by upload_queries before dispatch.
+    in_progress = getattr(UPLOAD_IN_PROGRESS, "names", None)
+    if in_progress is None:
+        in_progress = UPLOAD_IN_PROGRESS.names = set()
+    if query_name in in_progress:
+        raise RuntimeError(
+            "Dependency cycle detected while uploading query '%s'"
+            % query_name)
+
+    in_progress.add(query_name)
+    try:
+        with lock:
+            # If we already have an "uploaded_id", we've already been uploaded, just return the ID.
+            if "uploaded_id" in query_data:
+                return query_data["uploaded_id"]
+
+            # Change queryName back to queryId on query based parameters
+            if "parameters" in query_data["options"]:
+                for param in query_data["options"]["parameters"]:
+                    if param["type"] == "query":
+                        # Get queryId by calling ourselves recursively
+                        # - ensures that depended on query is already uploaded
+                        param["queryId"] = upload_query(
+                            redash, param["queryName"], saved_queries, existing_queries,
+                            slug_to_id)
+                        del param["queryName"]
+
+            # Query does not exist on server, create it
+            just_created = query_name not in existing_queries
+            if just_created:
+                print("Uploading query '%s' ..." % (query_name))
+                new_query = redash.create_query(query_data).json()
+                existing_queries[query_name] = new_query
+
+            query_id = existing_queries[query_name]["id"]
+            if just_created:
+                # create_query already sent the full payload; the only field the
+                # server may not have honoured is the published status, so patch
+                # just that rather than re-sending everything
+                if new_query.get("is_draft") != query_data.get("is_draft"):
+                    redash.update_query(
+                        query_id, {"is_draft": query_data.get("is_draft")})
+            else:
+                # Only send the fields that differ from what the server already
+                # has - re-posting the whole query (full SQL, options, ...) made
+                # the request body the dominant cost on no-op pushes
+                existing_query = existing_queries[query_name]
+                changed_fields = {
+                    field: query_data[field] for field in QUERY_UPDATE_FIELDS
+                    if field in query_data
+                    and existing_query.get(field) != query_data[field]}
+                if changed_fields:
+                    print("Updating query '%s' ..." % (query_name))
+                    redash.update_query(query_id, changed_fields)
+
+            query_data["uploaded_id"] = query_id
+
+            existing_visualisations = \
+                {viz["name"]: viz for viz in
+                 existing_queries[query_name]["visualizations"]}
+
+            # Build the payloads up front so nothing mutates while they are in flight
+            for visualization in query_data["visualizations"]:
+                visualization["query_id"] = query_id
+
+                for column in visualization["options"].get("columns", []):
+                    if column.get("displayAs") == "link":
+                        column["linkUrlTemplate"] = fix_dashboard_url_id(
+                            column["linkUrlTemplate"], slug_to_id)
+
+            def upload_visualization(visualization):
+                if visualization["name"] in existing_visualisations:
+                    return redash.update_visualization(
+                        existing_visualisations[visualization["name"]]["id"],
+                        visualization).json()
+                return create_visualization(redash, visualization)
+
+            # Visualizations on a query are independent of each other, so post them
+            # concurrently rather than one round trip at a time
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for visualization, uploaded_viz in zip(
+                        query_data["visualizations"],
+                        executor.map(upload_visualization,
+                                     query_data["visualizations"])):
+                    visualization["uploaded_id"] = uploaded_viz["id"]
+                    print("  Uploaded visualization '%s'" % visualization["name"])
+
+            return query_id
+
+    finally:
+        in_progress.discard(query_name)
 
 def load_saved_queries(datasource: dict):
     """Get queries for a datasource that were saved by fetch command"""
 
     source_type = datasource["type"]
     query_path = os.path.join("queries", source_type)
-    query_filenames = [i[:-len(METAFILE_SUFFIX)]
-                       for i in os.listdir(query_path) if
-                       i.endswith(METAFILE_SUFFIX)]
-
-    queries = {}
-    for filename in query_filenames:
+    # scandir's DirEntry caches the file type from the directory read, so
+    # this doesn't cost a stat per entry like listdir + filtering would
+    with os.scandir(query_path) as entries:
+        query_filenames = [entry.name[:-len(METAFILE_SUFFIX)]
+                           for entry in entries if
+                           entry.is_file()
+                           and entry.name.endswith(METAFILE_SUFFIX)]
+
+    def load_one(filename):
+        # Safe loader rather than round trip - push never writes the files
+        # back, so comments don't need preserving, and it parses with the
+        # libyaml C extension when ruamel.yaml.clib is installed. YAML
+        # instances aren't thread-safe, so each task gets its own.
+        yaml = ruamel.yaml.YAML(typ="safe")
         with open(os.path.join(query_path,
                                filename) + METAFILE_SUFFIX,
                   encoding="utf-8") as metadata_file_handle:
-            query_data = ruamel.yaml.load(
-                metadata_file_handle, Loader=ruamel.yaml.Loader)
+            query_data = yaml.load(metadata_file_handle)
 
         with open(os.path.join(query_path, filename),
                   encoding="utf-8") as query_file_handle:
@@ -195,9 +278,51 @@ def load_saved_queries(datasource: dict):
 
         query_data["data_source_id"] = datasource["id"]
 
-        queries[query_data["name"]] = query_data
+        return query_data["name"], query_data
+
+    # The files are independent, so read them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return dict(executor.map(load_one, query_filenames))
+
 
-    return queries
+def check_query_dependencies(saved_queries):
+    """Raise if query based parameters form a dependency cycle
+
+    upload_query holds its query's lock while recursing into the query's
+    dependencies, so a cycle reached from two worker threads would leave
+    them waiting on each other's locks forever. The dependency graph is
+    known entirely from the saved queries, so reject cycles up front with
+    an error naming the queries involved.
+
+    Arguments:
+    saved_queries -- Name-indexed dict of queries loaded from disk
+    """
+    def dependencies(query_name):
+        query_data = saved_queries.get(query_name)
+        if query_data is None:
+            return []
+        return [param["queryName"]
+                for param in query_data["options"].get("parameters", [])
+                if param["type"] == "query" and "queryName" in param]
+
+    checked = set()
+
+    def visit(query_name, path):
+        if query_name in checked:
+            return
+        if query_name in path:
+            cycle = path[path.index(query_name):] + [query_name]
+            raise RuntimeError(
+                "Dependency cycle in query based parameters: %s"
+                % " -> ".join("'%s'" % name for name in cycle))
+        path.append(query_name)
+        for dependency in dependencies(query_name):
+            visit(dependency, path)
+        path.pop()
+        checked.add(query_name)
+
+    for query_name in saved_queries:
+        visit(query_name, [])
 
 
 def upload_queries(redash: Redash, saved_queries, existing_queries, existing_dashboards):
@@ -206,15 +331,30 @@ def upload_queries(redash: Redash, saved_queries, existing_queries, existing_das
     This will upload all queries found in the "queries" folder on the filesystem
     of the type that matches the datasource and add them to the redash server.
 
+    Raises RuntimeError if the saved queries' query based parameters depend
+    on each other in a cycle.
+
     Arguments:
     redash -- Redash toolbelt instance to upload to
     saved_queries -- The saved queries to be uploaded
     existing_queries -- The existing queries downloaded from the redash server
     existing_dashboards -- The existing dashboards from the redash server
     """
-    for query_name in saved_queries:
-        upload_query(redash, query_name, saved_queries, existing_queries,
-                     existing_dashboards)
+    check_query_dependencies(saved_queries)
+
+    # Index dashboards by slug once rather than scanning the whole dict for
+    # every link column fix_dashboard_url_id rewrites
+    slug_to_id = {d["slug"]: d["id"] for d in existing_dashboards.values()}
+
+    # Queries only depend on each other through query based parameters, so
+    # upload them in parallel; upload_query's per-query locking ensures each
+    # one is still created exactly once however the workers reach it
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(
+            lambda query_name: upload_query(
+                redash, query_name, saved_queries, existing_queries,
+                slug_to_id),
+            saved_queries))
 
 
 def find_data_source(redash: Redash, datasource_name: str = None):
@@ -250,18 +390,21 @@ def load_saved_dashboards():
     """Get dashboards that were saved by fetch command"""
 
     dashboard_path = "dashboards"
-    dashboard_filenames = os.listdir(dashboard_path)
+    with os.scandir(dashboard_path) as entries:
+        dashboard_filenames = [entry.name for entry in entries
+                               if entry.is_file()]
 
-    dashboards = {}
-    for filename in dashboard_filenames:
+    def load_one(filename):
+        # One safe loader per task - see load_saved_queries
+        yaml = ruamel.yaml.YAML(typ="safe")
         with open(os.path.join(dashboard_path, filename),
                   encoding="utf-8") as file_handle:
-            dashboard_data = ruamel.yaml.load(
-                file_handle, Loader=ruamel.yaml.Loader)
+            dashboard_data = yaml.load(file_handle)
 
-        dashboards[dashboard_data["name"]] = dashboard_data
+        return dashboard_data["name"], dashboard_data
 
-    return dashboards
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return dict(executor.map(load_one, dashboard_filenames))
 
 
 def create_missing_dashboards(redash, saved_dashboards, existing_dashboards):
@@ -305,31 +448,38 @@ def update_dashboards(redash, saved_dashboards, existing_dashboards,
     saved_queries -- The queries whose visualisations are to be added to the dashboards
     """
     error = False
-    for name in saved_dashboards:
-        print("Updating dashboard '%s':" % name)
-        if existing_dashboards[name]["widgets"]:
-            for w in existing_dashboards[name]["widgets"]:
-                print("  Removing widget '%s' of query '%s'" % (w["visualization"]["name"], w["visualization"]["query"]["name"]))
-                delete_widget(redash, w["id"])
-
-        for w in saved_dashboards[name]["widgets"]:
-            queryName = w["visualization"]["queryName"]
-            visualisationName = w["visualization"]["name"]
-            print("  Adding widget '%s' of query '%s'" %
-                  (visualisationName, queryName))
-            query = saved_queries[queryName]
-            visualization = next((i for i in query["visualizations"] if i["name"] == visualisationName), None)
-            if not visualization:
-                error = True
-                logging.error(f"Could not find visualisation '{visualisationName}' on query '{queryName}'")
-                if visualisationName == "Table":
-                    logging.error("Note that the default 'Table' visualisation is not saved unless you edit it manually.")
-                continue
-            redash.create_widget(
-                existing_dashboards[name]["id"], visualization["uploaded_id"], w["text"],
-                w["options"]
-            )
-            print(" done")
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for name in saved_dashboards:
+            print("Updating dashboard '%s':" % name)
+            existing_widgets = existing_dashboards[name]["widgets"]
+            if existing_widgets:
+                for w in existing_widgets:
+                    print("  Removing widget '%s' of query '%s'" % (w["visualization"]["name"], w["visualization"]["query"]["name"]))
+                # Widgets are independent of each other (layout comes from
+                # options.position), so delete them as one concurrent wave
+                list(executor.map(lambda w: delete_widget(redash, w["id"]),
+                                  existing_widgets))
+
+            widgets_to_create = []
+            for w in saved_dashboards[name]["widgets"]:
+                queryName = w["visualization"]["queryName"]
+                visualisationName = w["visualization"]["name"]
+                print("  Adding widget '%s' of query '%s'" %
+                      (visualisationName, queryName))
+                query = saved_queries[queryName]
+                visualization = next((i for i in query["visualizations"] if i["name"] == visualisationName), None)
+                if not visualization:
+                    error = True
+                    logging.error(f"Could not find visualisation '{visualisationName}' on query '{queryName}'")
+                    if visualisationName == "Table":
+                        logging.error("Note that the default 'Table' visualisation is not saved unless you edit it manually.")
+                    continue
+                widgets_to_create.append((
+                    existing_dashboards[name]["id"],
+                    visualization["uploaded_id"], w["text"], w["options"]))
+            # Creates go in a second wave so they can't race the deletes
+            list(executor.map(lambda args: redash.create_widget(*args),
+                              widgets_to_create))
     if error:
         logging.info("Dashboards loaded with errors. See above for details.")
         return 1
@@ -385,24 +535,41 @@ def main(redash_url: str, api_key: str, datasource_name: str, log_level: str):
 
 def push(redash_url: str, api_key: str, datasource_name: str):
     """Upload dashboards and queries to a redash instance"""
-    redash = Redash(redash_url.rstrip("/"), api_key)
+    redash = make_redash_client(redash_url, api_key)
 
-    try:
-        datasource: dict = find_data_source(redash, datasource_name)
-    except RuntimeError as e:
-        exit(1)
+    # The dashboard and query downloads don't depend on each other, so run
+    # both at once and fan the per-item GETs out on the same pool rather
+    # than fetching one at a time
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        def fetch_existing(resource, get_item):
+            detail_futures = [executor.submit(get_item, item["id"])
+                              for item in redash.paginate(resource)]
+            return {item["name"]: item for item in (
+                future.result() for future in detail_futures)}
+
+        # Resolve the datasource before fanning out the downloads: a bad
+        # --data-source-name should exit immediately, not after spending
+        # rate limit on a full set of already-submitted detail GETs
+        try:
+            datasource: dict = find_data_source(redash, datasource_name)
+        except RuntimeError as e:
+            exit(1)
+
+        dashboards_future = executor.submit(
+            fetch_existing, redash.dashboards, redash.dashboard)
+        queries_future = executor.submit(
+            fetch_existing, redash.queries, redash.get_query)
 
-    existing_dashboards = {d["name"]: redash.dashboard(d["id"])
-                           for d in redash.paginate(redash.dashboards)}
+        existing_dashboards = dashboards_future.result()
 
-    saved_dashboards: dict = load_saved_dashboards()
+        saved_dashboards: dict = load_saved_dashboards()
 
-    create_missing_dashboards(redash, saved_dashboards, existing_dashboards)
+        create_missing_dashboards(redash, saved_dashboards,
+                                  existing_dashboards)
 
-    existing_queries: dict = {q["name"]: redash.get_query(
-        q["id"]) for q in redash.paginate(redash.queries)}
+        existing_queries: dict = queries_future.result()
 
-    saved_queries: dict = load_saved_queries(datasource)
+        saved_queries: dict = load_saved_queries(datasource)
 
     upload_queries(redash, saved_queries, existing_queries, existing_dashboards)
 
@@ -12,11 +12,55 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+from redash_toolbelt.client import Redash
+from requests.adapters import HTTPAdapter
+
+
+def make_redash_client(redash_url: str, api_key: str) -> Redash:
+    """
+    Creates a Redash client whose session keeps connections alive across
+    requests. The default adapter only pools a handful of sockets, so the
+    many small API calls made by fetch and push would each pay a fresh
+    TCP/TLS handshake; a larger pool lets concurrent workers reuse sockets.
+    """
+    redash = Redash(redash_url.rstrip("/"), api_key)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+    redash.session.mount("https://", adapter)
+    redash.session.mount("http://", adapter)
+    return redash
+
+
+def fsync_all(paths):
+    """
+    Flushes a batch of already-written files to stable storage. Syncing in
+    one concurrent pass after all the writes lets the kernel overlap the
+    flushes, instead of stalling once per file as it is closed.
+    """
+    def fsync_one(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        # Consume the iterator so any OSError surfaces here
+        list(executor.map(fsync_one, paths))
+
+
+# Runs of anything unsafe in a filename, collapsed to one underscore each.
+# A str.translate table would be faster still but maps characters one to
+# one, so it can't do the collapsing and would change existing filenames.
+FILENAME_UNSAFE_RE = re.compile(r"[^A-Za-z0-9]+")
+
 
 def make_filename(name):
     """
     Makes a filename-safe stub from an arbitrary title.
     Ex.: "My Life (And Hard Times)" -> "my_life_and_hard_times"
     """
-    return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_").lower()
+    return FILENAME_UNSAFE_RE.sub("_", name).strip("_").lower()